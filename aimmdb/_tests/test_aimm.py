@@ -2,6 +2,7 @@ import numpy as np
 import pandas as pd
 import pydantic
 import pytest
+from fastapi import HTTPException
 from tiled.authenticators import DictionaryAuthenticator
 from tiled.client import from_tree
 from tiled.queries import Contains, Eq, Key
@@ -10,7 +11,7 @@ import aimmdb
 from aimmdb.access import SimpleAccessPolicy
 from aimmdb.adapters.aimm import AIMMCatalog, key_to_query
 from aimmdb.queries import In, NotIn
-from aimmdb.schemas import XASDocument
+from aimmdb.schemas import SampleData, XASDocument
 
 from .utils import fail_with_status_code
 
@@ -88,6 +89,124 @@ def test_basic(tmpdir):
     assert len(c["uid"]) == 0
 
 
+def test_samples(tmpdir, monkeypatch):
+    data_directory = tmpdir / "data"
+    data_directory.mkdir()
+
+    tree = AIMMCatalog.from_mongomock(data_directory)
+
+    api_key = "secret"
+    c = from_tree(
+        tree, api_key=api_key, authentication={"single_user_api_key": api_key}
+    )
+
+    uid = c.write_sample({"name": "foo"})
+    uids = c.write_samples([{"name": "bar"}, {"name": "baz", "prep": "pellet"}])
+    assert len(set([uid, *uids])) == 3
+
+    names = {
+        doc["uid"]: doc["name"] for doc in tree.sample_collection.find({}, {"_id": False})
+    }
+    assert names == {uid: "foo", uids[0]: "bar", uids[1]: "baz"}
+
+    assert c.write_samples([]) == []
+
+    # a failed batch reports the samples written before the failure
+    generated = iter(["a", "b", "a"])
+    monkeypatch.setattr(aimmdb.uid, "uid", lambda: next(generated))
+    with pytest.raises(HTTPException) as excinfo:
+        tree.post_samples([SampleData(name=name) for name in ["x", "y", "z"]])
+    assert "['a', 'b']" in excinfo.value.detail
+    assert tree.sample_collection.count_documents({"uid": {"$in": ["a", "b"]}}) == 2
+    monkeypatch.undo()
+
+    # samples are validated before they are sent
+    with pytest.raises(pydantic.ValidationError):
+        c.write_samples([{"name": "qux"}, {"prep": "pellet"}])
+
+    # listing by sample injects the sample metadata into each child
+    x = np.random.rand(10)
+    for sample_id in names:
+        c["uid"].write_array(x, {"dataset": "sandbox", "sample_id": sample_id})
+    children = dict(tree["sample"].items())
+    assert {k: v.metadata["_tiled"]["sample"]["name"] for k, v in children.items()} == names
+
+
+def test_metadata_slice(tmpdir, monkeypatch):
+    data_directory = tmpdir / "data"
+    data_directory.mkdir()
+
+    tree = AIMMCatalog.from_mongomock(
+        data_directory,
+        spec_to_document_model={"XAS": XASDocument},
+        dataset_to_specs={"xas": ["XAS"]},
+    )
+
+    api_key = "secret"
+    c = from_tree(
+        tree, api_key=api_key, authentication={"single_user_api_key": api_key}
+    )
+
+    sample_ids = c.write_samples([{"name": "foo"}, {"name": "bar"}])
+    df = pd.DataFrame({"a": np.random.rand(10), "b": np.random.rand(10)})
+    for i, (symbol, edge) in enumerate([("Au", "K"), ("Cu", "L3"), ("Fe", "K")]):
+        metadata = {"dataset": "xas", "element": {"symbol": symbol, "edge": edge}}
+        if i < 2:
+            metadata["sample_id"] = sample_ids[i]
+        c["uid"].write_xas(df, metadata)
+    c["uid"].write_array(np.random.rand(10), {"dataset": "sandbox"})
+
+    # fetch the metadata slices in pages of 2 so slices cross a page boundary
+    metadata_slice = aimmdb.client.AIMMCatalog._metadata_slice
+    pages = []
+
+    def paged_metadata_slice(self, start, stop, fields):
+        pages.append((start, stop))
+        return metadata_slice(self, start, stop, fields, page_size=2)
+
+    monkeypatch.setattr(
+        aimmdb.client.AIMMCatalog, "_metadata_slice", paged_metadata_slice
+    )
+
+    # keys are annotated from a metadata slice the same way as from the items
+    def check(node, start=None, stop=None):
+        keys = [repr(k) for k in node.keys()[start:stop]]
+        items = [repr(k) for k, _ in node.items()[start:stop]]
+        assert keys == items
+        return keys
+
+    keys = check(c["uid"])
+    assert pages
+    assert len(keys) == 4
+    assert keys[0] == f"foo Au-K ({c['uid'].keys().first().uid})"
+    assert check(c["uid"], 1, 4) == keys[1:4]
+    # records without a sample are not listed and do not shift the pages
+    samples = check(c["sample"])
+    assert sorted(samples) == sorted(
+        [f"foo ({sample_ids[0]})", f"bar ({sample_ids[1]})"]
+    )
+    assert len(c["sample"]) == 2
+    assert check(c["sample"], 1, 2) == samples[1:2]
+    assert check(c["dataset"]["xas"]["uid"]) == keys[:3]
+    assert check(c["element"]["Au"]["uid"]) == keys[:1]
+    # client side queries fall back to the items
+    pages.clear()
+    assert check(c["uid"].search(Key("element.symbol") == "Cu")) == keys[1:2]
+    assert not pages
+
+    # overlapping fields are reduced to the outermost path
+    content = c.context.get_json(
+        "/node/metadata_slice/uid",
+        params={"fields": ["element", "element.symbol"], "limit": 1},
+    )
+    assert content["data"][0]["metadata"] == {"element": {"symbol": "Au", "edge": "K"}}
+
+    with fail_with_status_code(400):
+        c.context.get_json("/node/metadata_slice/uid", params={"fields": ["element."]})
+    with fail_with_status_code(422):
+        c.context.get_json("/node/metadata_slice/uid", params={"offset": -1})
+
+
 def main():
     pytest.main()
 
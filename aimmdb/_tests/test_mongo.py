@@ -1,16 +1,21 @@
+import mongomock
 import numpy as np
 import pandas as pd
 import pydantic
+import pymongo
 import pytest
+from fastapi import HTTPException
 from tiled.authenticators import DictionaryAuthenticator
 from tiled.client import from_tree
 from tiled.queries import Comparison, Contains, Eq, Key
+from tiled.serialization.dataframe import serialize_arrow
 
 import aimmdb
 from aimmdb.access import SimpleAccessPolicy
 from aimmdb.adapters.mongo import MongoAdapter
 from aimmdb.queries import In, NotIn
 from aimmdb.schemas import XASDocument
+from aimmdb.utils import query_comment
 
 from .utils import fail_with_status_code
 
@@ -32,11 +37,18 @@ def test_basic(tmpdir):
     metadata = {"foo": "bar"}
     key0 = c.write_array(x, metadata)
     assert len(c) == 1
+    assert key0 in tree
 
     node = c[key0]
     np.testing.assert_equal(x, node.read())
     assert {k: node.metadata[k] for k in metadata} == metadata
 
+    # the structure of a listed array comes from its document, not its file
+    node = dict(tree.items())[key0]
+    assert node.macrostructure().shape == x.shape
+    assert node.microstructure().to_numpy_dtype() == x.dtype
+    assert "array_adapter" not in node.__dict__
+
     df = pd.DataFrame({"a": np.random.rand(100), "b": np.random.rand(100)})
     metadata = {"a": 1, "b": 2}
     key1 = c.write_dataframe(df, metadata)
@@ -45,14 +57,131 @@ def test_basic(tmpdir):
     node = c[key1]
     pd.testing.assert_frame_equal(df, node.read())
     assert {k: node.metadata[k] for k in metadata} == metadata
+    pd.testing.assert_frame_equal(df[["b"]], c[key1].read(["b"]))
 
     del c[key0]
     assert len(c) == 1
+    assert key0 not in tree
 
     del c[key1]
     assert len(c) == 0
 
 
+def test_node_cache(tmpdir):
+    data_directory = tmpdir / "data"
+    data_directory.mkdir()
+    tree = MongoAdapter.from_mongomock(data_directory, node_cache_size=2)
+
+    api_key = "secret"
+    c = from_tree(
+        tree, api_key=api_key, authentication={"single_user_api_key": api_key}
+    )
+
+    x = np.random.rand(100, 100)
+    keys = [c.write_array(x, {"i": i}) for i in range(3)]
+    for key in keys:
+        np.testing.assert_equal(x, c[key].read())
+    assert len(tree.node_cache) == 2
+
+    # listings reuse cached nodes
+    nodes = dict(tree.items())
+    assert nodes[keys[-1]] is tree[keys[-1]]
+
+    # deleting a cached node evicts it from the cache
+    del c[keys[-1]]
+    assert len(tree.node_cache) == 1
+    with pytest.raises(KeyError):
+        c[keys[-1]]
+
+    # rewriting the data of a cached node evicts it from the cache
+    df = pd.DataFrame({"a": np.random.rand(10)})
+    key = c.write_dataframe(df, {})
+    pd.testing.assert_frame_equal(df, c[key].read())
+    df_new = pd.DataFrame({"a": np.random.rand(10)})
+    tree[key].put_data(serialize_arrow(df_new, {}))
+    assert all(k[0] != key for k in tree.node_cache._nodes)
+    pd.testing.assert_frame_equal(df_new, c[key].read())
+
+
+def test_put_data_structure(tmpdir):
+    data_directory = tmpdir / "data"
+    data_directory.mkdir()
+    tree = MongoAdapter.from_mongomock(data_directory)
+
+    api_key = "secret"
+    c = from_tree(
+        tree, api_key=api_key, authentication={"single_user_api_key": api_key}
+    )
+
+    df = pd.DataFrame({"a": np.random.rand(10), "b": list("abcdefghij")})
+    key = c.write_dataframe(df, {})
+    pd.testing.assert_frame_equal(df, c[key].read())
+
+    # data matching the posted structure can be rewritten
+    df_new = df.assign(a=np.random.rand(10))
+    tree[key].put_data(serialize_arrow(df_new, {}))
+    pd.testing.assert_frame_equal(df_new, c[key].read())
+
+    # data which does not match it is rejected
+    for df_bad in [df[["a"]], df.rename(columns={"a": "c"}), df.assign(a=1)]:
+        with pytest.raises(HTTPException) as excinfo:
+            tree[key].put_data(serialize_arrow(df_bad, {}))
+        assert excinfo.value.status_code == 400
+    pd.testing.assert_frame_equal(df_new, c[key].read())
+
+
+def test_length_cache(tmpdir):
+    data_directory = tmpdir / "data"
+    data_directory.mkdir()
+    tree = MongoAdapter.from_mongomock(data_directory, length_cache_ttl=60)
+
+    api_key = "secret"
+    c = from_tree(
+        tree, api_key=api_key, authentication={"single_user_api_key": api_key}
+    )
+
+    assert len(tree) == 0
+
+    # the cached length is used until it expires
+    x = np.random.rand(10)
+    c.write_array(x, {"i": 0})
+    assert len(tree) == 0
+    assert len(tree.search(Key("i") == 0)) == 1
+
+
+def test_pagination(tmpdir):
+    data_directory = tmpdir / "data"
+    data_directory.mkdir()
+    tree = MongoAdapter.from_mongomock(data_directory)
+
+    api_key = "secret"
+    c = from_tree(
+        tree, api_key=api_key, authentication={"single_user_api_key": api_key}
+    )
+
+    x = np.random.rand(10)
+    for i in range(5):
+        c.write_array(x, {"i": i})
+
+    keys = list(tree.keys())
+    assert len(keys) == 5
+    pages = [list(tree.keys()[i : i + 2]) for i in range(0, 5, 2)]
+    assert sum(pages, []) == keys
+
+    # pages are offsets into the current listing, also after a delete
+    assert list(tree.keys()[0:2]) == keys[0:2]
+    del c[keys[0]]
+    assert list(tree.keys()[2:4]) == keys[3:5]
+    assert list(c.keys()[2:4]) == keys[3:5]
+
+
+def test_query_comment():
+    # queries are tagged for the profiler of a real server only
+    collection = pymongo.MongoClient(connect=False).db.metadata
+    assert query_comment(collection, "op") == {"comment": "aimmdb.op"}
+    assert query_comment(mongomock.MongoClient().db.metadata, "op") == {}
+
+
 def test_access(enter_password, tmpdir):
     data_directory = tmpdir / "data"
     data_directory.mkdir()
@@ -228,6 +357,11 @@ def test_queries(tmpdir):
     assert len(results) == 11
     assert sorted([x.metadata["i"] for x in results]) == list(range(0, 11))
 
+    # both queries constrain the same key
+    results = c.search(Key("i") > 5).search(Key("i") < 10).values()
+    assert len(results) == 4
+    assert sorted([x.metadata["i"] for x in results]) == list(range(6, 10))
+
     targets = [1, 3, 5, 7]
     results = c.search(In("i", targets)).values()
     assert len(results) == len(targets)
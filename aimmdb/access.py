@@ -40,9 +40,12 @@ class SimpleAccessPolicy:
     >>> SimpleAccessPolicy({"alice": "rw", "bob": "r"}, provider="toy")
     """
 
+    __slots__ = ("access_lists", "provider", "_ids")
+
     def __init__(self, access_lists, *, provider):
         self.access_lists = {}
         self.provider = provider
+        self._ids = {}  # principal uuid -> id
         for key, value in access_lists.items():
             if key == "public":
                 key = SpecialUsers.public
@@ -57,9 +60,13 @@ class SimpleAccessPolicy:
             return None
         elif isinstance(principal, SpecialUsers):
             return principal
+        elif principal.uuid in self._ids:
+            # principals are rebuilt for every request but their uuid is stable
+            return self._ids[principal.uuid]
         else:
             for identity in principal.identities:
                 if identity.provider == self.provider:
+                    self._ids[principal.uuid] = identity.id
                     return identity.id
             else:
                 raise ValueError(
@@ -88,9 +95,12 @@ class DatasetAccessPolicy:
     >>> DatasetAccessPolicy({"alice": {"foo" : "r", "bar" : "rw"}, "bob": {"foo" : "r", "bar" : "r"}}, provider="toy")
     """
 
+    __slots__ = ("access_lists", "provider", "_ids")
+
     def __init__(self, access_lists, *, provider):
         self.access_lists = {}
         self.provider = provider
+        self._ids = {}  # principal uuid -> id
 
         # FIXME how to handle a normal user with the admin role?
         self.access_lists[SpecialUsers.admin] = defaultdict(lambda: {READ, WRITE})
@@ -118,9 +128,13 @@ class DatasetAccessPolicy:
             return None
         elif isinstance(principal, SpecialUsers):
             return principal
+        elif principal.uuid in self._ids:
+            # principals are rebuilt for every request but their uuid is stable
+            return self._ids[principal.uuid]
         else:
             for identity in principal.identities:
                 if identity.provider == self.provider:
+                    self._ids[principal.uuid] = identity.id
                     return identity.id
             else:
                 raise ValueError(
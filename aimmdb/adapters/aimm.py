@@ -4,6 +4,7 @@ import json
 import os
 from collections import defaultdict
 from datetime import datetime
+from functools import cached_property
 from pathlib import Path
 
 import pydantic
@@ -14,7 +15,6 @@ from tiled.iterviews import ItemsView, KeysView, ValuesView
 from tiled.queries import Comparison, Eq
 from tiled.query_registration import QueryTranslationRegistry
 from tiled.structures.core import StructureFamily
-from tiled.serialization.dataframe import serialize_arrow
 from tiled.utils import (
     APACHE_ARROW_FILE_MIME_TYPE,
     UNCHANGED,
@@ -30,13 +30,26 @@ from aimmdb.adapters.array import WritingArrayAdapter
 from aimmdb.adapters.dataframe import WritingDataFrameAdapter
 from aimmdb.queries import OperationEnum, parse_path, register_queries_helper
 from aimmdb.schemas import GenericDocument
-from aimmdb.utils import make_dict
+from aimmdb.utils import LazyRouters, make_dict, query_comment
 
 _mime_structure_association = {
     StructureFamily.array: "application/x-hdf5",
     StructureFamily.dataframe: APACHE_ARROW_FILE_MIME_TYPE,
 }
 
+_adapter_structure_association = {
+    StructureFamily.array: WritingArrayAdapter,
+    StructureFamily.dataframe: WritingDataFrameAdapter,
+}
+
+# listings fetch small documents so get more of them per round trip than the
+# server default (101 documents in the first batch)
+_cursor_batch_size = 500
+
+# nodes read their data from data_url so leave out the unused inline blob
+_node_projection = {"_id": False, "data_blob": False}
+
+
 key_to_query = {
     "uid": "uid",
     "element": "metadata.element.symbol",
@@ -45,6 +58,62 @@ key_to_query = {
     "sample": "metadata.sample_id",
 }
 
+_listing_index = "last_modified_uid"
+
+# indexes for listings where a path selects on a single key
+_select_listing_indexes = {
+    field: f"{key}_last_modified_uid"
+    for key, field in key_to_query.items()
+    if field != "uid"
+}
+
+
+def create_indexes(metadata_db):
+    metadata_collection = metadata_db.get_collection("metadata")
+    # duplicate uids are rejected on insert so lookups can use find_one
+    metadata_collection.create_index(
+        [("uid", pymongo.ASCENDING)], name="uid", unique=True
+    )
+    # listings sort by last_modified and project the uid so they can be
+    # answered from an index, also when a path selects on one of the keys
+    metadata_collection.create_index(
+        [("last_modified", pymongo.ASCENDING), ("uid", pymongo.ASCENDING)],
+        name=_listing_index,
+    )
+    for field, name in _select_listing_indexes.items():
+        metadata_collection.create_index(
+            [
+                (field, pymongo.ASCENDING),
+                ("last_modified", pymongo.ASCENDING),
+                ("uid", pymongo.ASCENDING),
+            ],
+            name=name,
+        )
+
+    # samples are looked up by uid when denormalizing them into measurements
+    # and when a path selects on sample
+    metadata_db.get_collection("samples").create_index(
+        [("uid", pymongo.ASCENDING)], name="uid", unique=True
+    )
+
+
+# select dotted paths from a nested dict (like a mongo projection)
+def _select_fields(metadata, fields):
+    out = {}
+    for field in fields:
+        *parents, last = field.split(".")
+        src, dst = metadata, out
+        for part in parents:
+            src = src.get(part)
+            if not isinstance(src, collections.abc.Mapping):
+                break
+            dst = dst.setdefault(part, {})
+        else:
+            if last in src:
+                dst[last] = src[last]
+    return out
+
+
 # default document model requires dataset in metadata
 class MetadataBase(pydantic.BaseModel, extra=pydantic.Extra.allow):
     dataset: str
@@ -61,10 +130,9 @@ class AIMMCatalog(collections.abc.Mapping):
     register_query = query_registry.register
     register_query_lazy = query_registry.register_lazy
 
-    from aimmdb.server.router import router
-    from aimmdb.server.router_tiled import router as router_tiled
-
-    include_routers = [router, router_tiled]
+    include_routers = LazyRouters(
+        "aimmdb.server.router:router", "aimmdb.server.router_tiled:router"
+    )
 
     def __init__(
         self,
@@ -79,6 +147,7 @@ class AIMMCatalog(collections.abc.Mapping):
         path=None,
         spec_to_document_model=None,
         dataset_to_specs=None,
+        samples=None,
     ):
 
         # FIXME try to do less everytime we construct a new object
@@ -119,7 +188,15 @@ class AIMMCatalog(collections.abc.Mapping):
         sample_query = key_to_query["sample"]
         if sample_query in self.op.select:
             sample_id = self.op.select[sample_query]
-            sample = self.sample_collection.find_one({"uid": sample_id}, {"_id": False})
+            if samples is not None:
+                # already fetched by the parent listing
+                sample = samples.get(sample_id)
+            else:
+                sample = self.sample_collection.find_one(
+                    {"uid": sample_id},
+                    {"_id": False},
+                    **query_comment(self.sample_collection, "AIMMCatalog.sample"),
+                )
             if sample is not None:
                 self.metadata["_tiled"]["sample"] = sample
 
@@ -136,7 +213,7 @@ class AIMMCatalog(collections.abc.Mapping):
 
         super().__init__()
 
-    @property
+    @cached_property
     def sorting(self):
         return [(k, v) for k, v in self._sorting.items()]
 
@@ -156,6 +233,7 @@ class AIMMCatalog(collections.abc.Mapping):
                 f"Invalid URI: {uri!r} " f"Did you forget to include a database?"
             )
         metadata_db = pymongo.MongoClient(uri).get_database()
+        create_indexes(metadata_db)
 
         return cls(
             metadata_db=metadata_db,
@@ -180,6 +258,7 @@ class AIMMCatalog(collections.abc.Mapping):
 
         mongo_client = mongomock.MongoClient()
         metadata_db = mongo_client["test"]
+        create_indexes(metadata_db)
 
         return cls(
             metadata_db=metadata_db,
@@ -282,6 +361,38 @@ class AIMMCatalog(collections.abc.Mapping):
         assert result.acknowledged == True
         return sample.uid
 
+    def post_samples(self, samples):
+        # FIXME this is a bit adhoc (samples is not a 'real' dataset)
+        dataset = "samples"
+        permissions = self.permissions(dataset)
+        if WRITE not in permissions:
+            raise HTTPException(
+                status_code=403,
+                detail=f"principal does not have write permissions to dataset {dataset}",
+            )
+
+        if not samples:
+            return []
+
+        for sample in samples:
+            sample.uid = aimmdb.uid.uid()
+        uids = [sample.uid for sample in samples]
+        # one round trip for the whole batch, an ordered insert stops at the
+        # first failure so the samples before it are exactly the ones written
+        try:
+            result = self.sample_collection.insert_many(
+                [sample.dict() for sample in samples], ordered=True
+            )
+        except pymongo.errors.BulkWriteError as err:
+            written = uids[: err.details["nInserted"]]
+            message = err.details["writeErrors"][0]["errmsg"]
+            raise HTTPException(
+                status_code=500,
+                detail=f"failed to write samples after writing {written}: {message}",
+            )
+        assert result.acknowledged
+        return uids
+
     def delete_sample(self, uid):
         # FIXME this is a bit adhoc (samples is not a 'real' dataset)
         dataset = "samples"
@@ -372,41 +483,54 @@ class AIMMCatalog(collections.abc.Mapping):
                 else:
                     doc_dict["metadata"]["sample"] = sample
 
-        self.metadata_collection.insert_one(doc_dict)
+        # the document was already validated by pydantic above
+        self.metadata_collection.insert_one(doc_dict, bypass_document_validation=True)
         return key
 
     def _build_node_from_doc(self, doc):
+        adapter = _adapter_structure_association.get(doc["structure_family"])
+        if adapter is None:
+            raise ValueError("Unsupported Structure Family value in the databse")
+
         specs = doc.get("specs", [])
         document_model = self._get_document_model(specs)
 
-        doc = document_model.parse_obj(doc)
+        doc = document_model.from_mongo(doc)
         dataset = doc.metadata.dataset
 
         permissions = self.permissions(dataset)
 
-        if doc.structure_family == StructureFamily.array:
-            return WritingArrayAdapter(
-                self.metadata_collection,
-                self.data_directory,
-                doc,
-                permissions,
-            )
-        elif doc.structure_family == StructureFamily.dataframe:
-            return WritingDataFrameAdapter(
-                self.metadata_collection,
-                self.data_directory,
-                doc,
-                permissions,
-            )
-        else:
-            raise ValueError("Unsupported Structure Family value in the databse")
+        return adapter(
+            self.metadata_collection,
+            self.data_directory,
+            doc,
+            permissions,
+        )
+
+    @cached_property
+    def _base_query(self):
+        # the search queries are fixed for this instance so merge them once,
+        # None if their predicates overlap and they must be combined with $and
+        merged = {}
+        for query in self.queries:
+            if not merged.keys().isdisjoint(query):
+                return None
+            merged.update(query)
+        return merged
 
     def _build_mongo_query(self, *queries):
-        combined = self.queries + list(queries)
-        if combined:
-            return {"$and": combined}
-        else:
-            return {}
+        # merge into a single flat filter so equivalent queries share a shape
+        # in the plan cache, only fall back to $and if predicates overlap
+        if self._base_query is not None:
+            # copy as the result may be modified by the caller
+            merged = dict(self._base_query)
+            for query in queries:
+                if not merged.keys().isdisjoint(query):
+                    break
+                merged.update(query)
+            else:
+                return merged
+        return {"$and": self.queries + list(queries)}
 
     def __getitem__(self, key):
         path = self.path + [key]
@@ -415,16 +539,14 @@ class AIMMCatalog(collections.abc.Mapping):
         # if new path is a lookup, do it now
         if op.op_enum == OperationEnum.lookup:
             query = self._build_mongo_query(op.select)
-            docs = list(self.metadata_collection.find(query))
-
-            if len(docs) == 0:
+            doc = self.metadata_collection.find_one(
+                query,
+                _node_projection,
+                **query_comment(self.metadata_collection, "AIMMCatalog.__getitem__"),
+            )
+            if doc is None:
                 raise KeyError(f"{key} not found")
 
-            if len(docs) > 1:
-                raise KeyError(f"{key} matched multipled records")
-
-            doc = docs[0]
-
             return self._build_node_from_doc(doc)
 
         else:
@@ -435,14 +557,21 @@ class AIMMCatalog(collections.abc.Mapping):
             return len(self.op.keys)
         elif self.op.op_enum == OperationEnum.distinct:
             query = self._build_mongo_query(self.op.select)
+            comment = query_comment(self.metadata_collection, "AIMMCatalog.__len__")
             # NOTE _id is guarenteed unique
             if self.op.distinct == "uid":
-                return self.metadata_collection.count_documents(query)
+                if self._listing_hint is None:
+                    return self.metadata_collection.count_documents(query, **comment)
+                return self.metadata_collection.count_documents(
+                    query, hint=self._listing_hint, **comment
+                )
             else:
                 # FIXME wasteful to do the full self.op just to get the length
-                return len(
-                    self.metadata_collection.find(query).distinct(self.op.distinct)
+                distinct = self.metadata_collection.find(query, **comment).distinct(
+                    self.op.distinct
                 )
+                # NOTE documents without the key are not listed
+                return sum(v is not None for v in distinct)
         elif self.op.op_enum == OperationEnum.lookup:
             raise RuntimeError("unreachable")
         else:
@@ -460,41 +589,116 @@ class AIMMCatalog(collections.abc.Mapping):
 
         if self.op.op_enum == OperationEnum.keys:
             keys = list(self.op.keys) if order == 1 else list(reversed(self.op.keys))
-            yield from keys[skip : skip + limit]
+            yield from keys[skip:stop]
         elif self.op.op_enum == OperationEnum.distinct:
-            query = self._build_mongo_query(self.op.select)
-            sorting = [
-                ("last_modified", order)
-            ]  # natural given order is by last_modified
-
             # NOTE uid is guarenteed unique
             if self.op.distinct == "uid":
-                for doc in (
-                    self.metadata_collection.find(query, {"uid": 1})
-                    .sort(sorting)
-                    .skip(skip)
-                    .limit(limit)
-                ):
+                projection = {"uid": True, "_id": False}
+                for doc in self._find_uid_slice(skip, limit, order, projection):
                     yield doc["uid"]
             else:
+                query = self._build_mongo_query(self.op.select)
                 # FIXME wasteful to recompute this here (compute on construction?)
-                distinct = self.metadata_collection.find(query).distinct(
-                    self.op.distinct
-                )
+                distinct = self.metadata_collection.find(
+                    query,
+                    **query_comment(self.metadata_collection, "AIMMCatalog._keys_slice"),
+                ).distinct(self.op.distinct)
+                # drop documents without the key before slicing so offsets
+                # (and the length) only count listed values
+                distinct = [v for v in distinct if v is not None]
                 if order == -1:
                     distinct = list(reversed(distinct))
-                for v in distinct[skip : skip + limit]:
-                    if v is not None: # FIXME how should we filter None
-                        yield v
+                yield from distinct[skip:stop]
         elif self.op.op_enum == OperationEnum.lookup:
             raise RuntimeError("unreachable")
         else:
             raise RuntimeError("unreachable")
 
+    def _find_uid_slice(self, skip, limit, order, projection):
+        if limit is None:
+            limit = 0  # NOTE mongo treats a limit of 0 as no limit
+        elif limit <= 0:
+            return iter(())
+        query = self._build_mongo_query(self.op.select)
+        # natural given order is by last_modified, uid breaks ties so pages
+        # are stable and the sort matches the listing indexes
+        sorting = [("last_modified", order), ("uid", order)]
+        cursor = self.metadata_collection.find(
+            query,
+            projection,
+            **query_comment(self.metadata_collection, "AIMMCatalog._find_uid_slice"),
+        )
+        if self._listing_hint is not None:
+            cursor = cursor.hint(self._listing_hint)
+        return (
+            cursor.sort(sorting)
+            .skip(skip)
+            .limit(limit)
+            .batch_size(_cursor_batch_size)
+        )
+
+    @cached_property
+    def _listing_hint(self):
+        # the planner may prefer the uid index for unselective filters and
+        # then sort in memory, so name the index when the filter shape is known
+        if self.queries:
+            return None
+        if not self.op.select:
+            return _listing_index
+        if len(self.op.select) == 1:
+            (field,) = self.op.select
+            return _select_listing_indexes.get(field)
+        return None
+
     def _items_slice(self, start, stop, direction):
-        for k in self._keys_slice(start, stop, direction):
-            # FIXME note this is wasteful because it requires a second db lookup to get the value
-            yield (k, self[k])
+        if self.op.op_enum == OperationEnum.distinct and self.op.distinct == "uid":
+            # fetch the documents for the whole slice with one query instead of
+            # looking up each uid separately
+            assert direction == 1, "direction=-1 should be handled by the client"
+            skip = start or 0
+            limit = stop - skip if stop is not None else None
+            order = self._sorting["_"]
+            for doc in self._find_uid_slice(skip, limit, order, _node_projection):
+                yield (doc["uid"], self._build_node_from_doc(doc))
+        elif (
+            self.op.op_enum == OperationEnum.distinct
+            and self.op.distinct == key_to_query["sample"]
+        ):
+            # look up the samples for the whole slice with one query instead of
+            # one per child
+            keys = list(self._keys_slice(start, stop, direction))
+            samples = {
+                sample["uid"]: sample
+                for sample in self.sample_collection.find(
+                    {"uid": {"$in": keys}},
+                    {"_id": False},
+                    **query_comment(self.sample_collection, "AIMMCatalog._items_slice"),
+                )
+            }
+            for k in keys:
+                yield (k, self.new_variation(path=self.path + [k], samples=samples))
+        else:
+            for k in self._keys_slice(start, stop, direction):
+                yield (k, self[k])
+
+    def metadata_slice(self, start, stop, fields):
+        """
+        Yield (key, metadata, specs) for a slice where metadata only has fields
+
+        fields are dotted paths into the metadata e.g. element.symbol
+        """
+        if self.op.op_enum == OperationEnum.distinct and self.op.distinct == "uid":
+            # project just the requested fields without building nodes
+            skip = start or 0
+            limit = stop - skip if stop is not None else None
+            order = self._sorting["_"]
+            projection = {"uid": True, "specs": True, "_id": False}
+            projection.update({f"metadata.{field}": True for field in fields})
+            for doc in self._find_uid_slice(skip, limit, order, projection):
+                yield doc["uid"], doc.get("metadata", {}), doc.get("specs", [])
+        else:
+            for k, v in self._items_slice(start, stop, 1):
+                yield k, _select_fields(v.metadata, fields), list(v.specs)
 
     def __iter__(self):
         yield from self.keys()
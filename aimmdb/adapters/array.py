@@ -1,5 +1,6 @@
 import os
 from datetime import datetime
+from functools import cached_property
 from sys import platform
 
 import dask
@@ -7,6 +8,7 @@ import h5py
 import numpy as np
 from tiled.adapters.array import ArrayAdapter
 from tiled.server.pydantic_array import ArrayStructure
+from tiled.structures.array import ArrayMacroStructure, BuiltinDtype, StructDtype
 
 from aimmdb.access import require_write_permission
 
@@ -28,20 +30,25 @@ class WritingArrayAdapter:
         self.metadata_collection = metadata_collection
         self.directory = directory
         self.doc = doc
-        self.array_adapter = None
         self.permissions = list(permissions or [])
 
-        if self.doc.data_url is not None:
-            path = self.doc.data_url.path
-            if platform == "win32" and path[0] == "/":
-                path = path[1:]
+    # open the file on first use so listings do not open every file
+    @cached_property
+    def array_adapter(self):
+        if self.doc.data_url is None:
+            # if self.doc.data_blob is not None:
+            #     return ArrayAdapter(dask.array.from_array(self.doc.data_blob))
+            return None
 
-            file = h5py.File(path)
-            dataset = file["data"]
-            self.array_adapter = ArrayAdapter(dask.array.from_array(dataset))
+        path = self.doc.data_url.path
+        if platform == "win32" and path[0] == "/":
+            path = path[1:]
 
-    #        elif self.doc.data_blob is not None:
-    #            self.array_adapter = ArrayAdapter(dask.array.from_array(self.doc.data_blob))
+        file = h5py.File(path)
+        dataset = file["data"]
+        # use the stored chunks so blocks match the served macrostructure
+        chunks = self.doc.structure.macro.chunks
+        return ArrayAdapter(dask.array.from_array(dataset, chunks=chunks))
 
     @property
     def specs(self):
@@ -66,11 +73,16 @@ class WritingArrayAdapter:
     def read_block(self, *args, **kwargs):
         return self.array_adapter.read_block(*args, **kwargs)
 
+    # NOTE the stored structure matches the data (put_data shapes the array
+    # with it) so listings do not have to open the file
     def microstructure(self):
-        return self.array_adapter.microstructure()
+        dtype = self.doc.structure.micro.to_numpy_dtype()
+        if dtype.fields is not None:
+            return StructDtype.from_numpy_dtype(dtype)
+        return BuiltinDtype.from_numpy_dtype(dtype)
 
     def macrostructure(self):
-        return self.array_adapter.macrostructure()
+        return ArrayMacroStructure(**self.doc.structure.macro.dict())
 
     @require_write_permission
     def put_data(self, body):
@@ -1,20 +1,28 @@
 import os
 from datetime import datetime
+from functools import cached_property
 from sys import platform
 
 import dask
-import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
 from fastapi import HTTPException
 from tiled.adapters.dataframe import DataFrameAdapter
-from tiled.structures.dataframe import DataFrameStructure
-from tiled.serialization.dataframe import deserialize_arrow
+from tiled.server.object_cache import with_object_cache
+from tiled.structures.dataframe import (
+    DataFrameMacroStructure,
+    DataFrameMicroStructure,
+    DataFrameStructure,
+)
 
 from aimmdb.access import require_write_permission
+from aimmdb.serialization import read_parquet
 
 
 def dataframe_raise_if_inactive(method):
     def inner(self, *args, **kwargs):
-        if self.dataframe_adapter is None:
+        # NOTE check data_url to avoid loading the dataframe here
+        if self.doc.data_url is None:
             raise ValueError("Not active")
         else:
             return method(self, *args, **kwargs)
@@ -30,17 +38,37 @@ class WritingDataFrameAdapter:
         self.metadata_collection = metadata_collection
         self.directory = directory
         self.doc = doc
-        self.dataframe_adapter = None
         self.permissions = list(permissions or [])
 
-        if self.doc.data_url is not None:
-            path = self.doc.data_url.path
-            if platform == "win32" and path[0] == "/":
-                path = path[1:]
+    @property
+    def _path(self):
+        path = self.doc.data_url.path
+        if platform == "win32" and path[0] == "/":
+            path = path[1:]
+        return path
+
+    # read the data on first use so listings do not load every dataframe
+    @cached_property
+    def dataframe_adapter(self):
+        if self.doc.data_url is None:
+            return None
+
+        # share decoded dataframes between requests through tiled's object
+        # cache, put_data bumps last_modified so rewritten data gets a new key
+        cache_key = (
+            type(self).__module__,
+            type(self).__qualname__,
+            self.doc.uid,
+            self.doc.last_modified,
+        )
+        dataframe = with_object_cache(cache_key, read_parquet, self._path)
+        return DataFrameAdapter.from_pandas(dataframe, npartitions=1)
 
-            self.dataframe_adapter = DataFrameAdapter.from_pandas(
-                pd.read_parquet(path), npartitions=1
-            )
+    def _read_fields(self, fields):
+        if "dataframe_adapter" in self.__dict__:
+            return self.dataframe_adapter.read(fields)
+        # parquet is columnar so only read the requested columns from disk
+        return read_parquet(self._path, columns=list(fields))
 
     @property
     def specs(self):
@@ -58,30 +86,63 @@ class WritingDataFrameAdapter:
         return out
 
     @dataframe_raise_if_inactive
-    def read(self, *args, **kwargs):
-        return self.dataframe_adapter.read(*args, **kwargs)
+    def read(self, fields=None):
+        if fields is not None:
+            return self._read_fields(fields)
+        return self.dataframe_adapter.read()
 
     @dataframe_raise_if_inactive
-    def read_partition(self, *args, **kwargs):
-        return self.dataframe_adapter.read_partition(*args, **kwargs)
-
+    def read_partition(self, partition, fields=None):
+        # NOTE the data is stored as a single partition
+        if fields is not None and partition == 0:
+            return self._read_fields(fields)
+        return self.dataframe_adapter.read_partition(partition, fields=fields)
+
+    # NOTE the stored structure matches the data (put_data checks the schema and
+    # both use a single partition)
     def microstructure(self):
-        return self.dataframe_adapter.microstructure()
+        return DataFrameMicroStructure(**self.doc.structure.micro.dict())
 
     def macrostructure(self):
-        return self.dataframe_adapter.macrostructure()
+        return DataFrameMacroStructure(**self.doc.structure.macro.dict())
+
+    def _check_schema(self, schema):
+        # the structure was posted with the metadata and is served as is, so
+        # the data must match it
+        # NOTE columns which are empty in meta (e.g. strings) have a null type
+        meta = pa.ipc.open_file(pa.py_buffer(self.doc.structure.micro.meta)).schema
+        index_columns = {
+            column
+            for column in (schema.pandas_metadata or {}).get("index_columns", [])
+            if isinstance(column, str)
+        }
+        columns = [name for name in schema.names if name not in index_columns]
+        if (
+            schema.names != meta.names
+            or columns != list(self.doc.structure.macro.columns)
+            or not all(
+                pa.types.is_null(expected) or expected == actual
+                for expected, actual in zip(meta.types, schema.types)
+            )
+        ):
+            raise HTTPException(
+                status_code=400,
+                detail=f"data with schema {schema} does not match structure {meta}",
+            )
 
     @require_write_permission
     def put_data(self, body):
+        # write the arrow table as is, the pandas metadata in its schema lets
+        # read_parquet restore the dataframe (index included) on read
+        table = pa.ipc.open_file(body).read_all()
+        self._check_schema(table.schema)
 
         # Organize files into subdirectories with the first two
         # charcters of the uid to avoid one giant directory.
         path = self.directory / self.doc.uid[:2] / self.doc.uid
         path.parent.mkdir(parents=True, exist_ok=True)
 
-        dataframe = deserialize_arrow(body)
-
-        dataframe.to_parquet(path)
+        pq.write_table(table, path)
         result = self.metadata_collection.update_one(
             {"uid": self.doc.uid},
             {
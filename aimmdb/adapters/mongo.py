@@ -2,7 +2,10 @@ import collections.abc
 import dataclasses
 import json
 import os
+import threading
+import time
 from collections import defaultdict
+from functools import cached_property
 from pathlib import Path
 
 import fastapi
@@ -15,7 +18,6 @@ from tiled.iterviews import ItemsView, KeysView, ValuesView
 from tiled.queries import Comparison, Eq
 from tiled.query_registration import QueryTranslationRegistry
 from tiled.structures.core import StructureFamily
-from tiled.structures.dataframe import serialize_arrow
 from tiled.utils import (APACHE_ARROW_FILE_MIME_TYPE, UNCHANGED, DictView,
                          ListView, import_object)
 
@@ -25,13 +27,130 @@ from aimmdb.adapters.array import WritingArrayAdapter
 from aimmdb.adapters.dataframe import WritingDataFrameAdapter
 from aimmdb.queries import register_queries_helper
 from aimmdb.schemas import GenericDocument
-from aimmdb.utils import make_dict
+from aimmdb.utils import LazyRouters, make_dict, query_comment
 
 _mime_structure_association = {
     StructureFamily.array: "application/x-hdf5",
     StructureFamily.dataframe: APACHE_ARROW_FILE_MIME_TYPE,
 }
 
+_adapter_structure_association = {
+    StructureFamily.array: WritingArrayAdapter,
+    StructureFamily.dataframe: WritingDataFrameAdapter,
+}
+
+# documents are only listed once their data has been written
+# NOTE post_metadata stores data_url=None so $exists alone is not enough
+_has_data = {"data_url": {"$type": "string"}}
+
+# listings fetch small documents so get more of them per round trip than the
+# server default (101 documents in the first batch)
+_cursor_batch_size = 500
+
+# nodes read their data from data_url so leave out the unused inline blob
+_node_projection = {"_id": False, "data_blob": False}
+
+_listing_index = "last_modified_uid_has_data"
+
+
+def create_indexes(metadata_collection):
+    # duplicate uids are rejected on insert so lookups can use find_one
+    metadata_collection.create_index(
+        [("uid", pymongo.ASCENDING)], name="uid", unique=True
+    )
+    # listings filter on _has_data and sort by last_modified, the partial
+    # index only holds those documents so they avoid a collection scan and an
+    # in memory sort, data_url is not a key so each document is still fetched
+    metadata_collection.create_index(
+        [("last_modified", pymongo.ASCENDING), ("uid", pymongo.ASCENDING)],
+        name=_listing_index,
+        partialFilterExpression=_has_data,
+    )
+
+
+class NodeCache:
+    """
+    A thread-safe LRU cache of nodes keyed by (uid, permissions)
+
+    Deleting or rewriting the data of a cached node evicts every entry for
+    its uid.
+    """
+
+    def __init__(self, maxsize):
+        self.maxsize = maxsize
+        self._nodes = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._nodes)
+
+    def get(self, key):
+        with self._lock:
+            node = self._nodes.get(key)
+            if node is not None:
+                self._nodes.move_to_end(key)
+            return node
+
+    def put(self, key, node):
+        uid = key[0]
+        delete = node.delete
+
+        def delete_and_evict():
+            self.evict(uid)
+            return delete()
+
+        node.delete = delete_and_evict
+
+        put_data = getattr(node, "put_data", None)
+        if put_data is not None:
+
+            def put_data_and_evict(body):
+                self.evict(uid)
+                return put_data(body)
+
+            node.put_data = put_data_and_evict
+
+        with self._lock:
+            self._nodes[key] = node
+            self._nodes.move_to_end(key)
+            while len(self._nodes) > self.maxsize:
+                self._nodes.popitem(last=False)
+
+    def evict(self, uid):
+        with self._lock:
+            for key in [key for key in self._nodes if key[0] == uid]:
+                del self._nodes[key]
+
+
+class LengthCache:
+    """
+    A thread-safe cache of listing lengths keyed by query
+
+    Entries expire after ttl seconds so writes are counted after at most ttl.
+    """
+
+    def __init__(self, ttl):
+        self.ttl = ttl
+        self._lengths = {}
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._lengths)
+
+    def get(self, key):
+        with self._lock:
+            entry = self._lengths.get(key)
+        if entry is None or entry[0] < time.monotonic():
+            return None
+        return entry[1]
+
+    def put(self, key, length):
+        now = time.monotonic()
+        with self._lock:
+            # drop expired entries so one-off searches do not accumulate
+            self._lengths = {k: v for k, v in self._lengths.items() if v[0] >= now}
+            self._lengths[key] = (now + self.ttl, length)
+
 
 class Metadata(pydantic.BaseModel, extra=pydantic.Extra.allow):
     pass
@@ -48,9 +167,7 @@ class MongoAdapter(collections.abc.Mapping):
     register_query = query_registry.register
     register_query_lazy = query_registry.register_lazy
 
-    from aimmdb.server.router_tiled import router as router_tiled
-
-    include_routers = [router_tiled]
+    include_routers = LazyRouters("aimmdb.server.router_tiled:router")
 
     def __init__(
         self,
@@ -63,6 +180,10 @@ class MongoAdapter(collections.abc.Mapping):
         principal=None,
         access_policy=None,
         spec_to_document_model=None,
+        node_cache_size=0,
+        node_cache=None,
+        length_cache_ttl=0,
+        length_cache=None,
     ):
         self.data_directory = Path(data_directory).resolve()
         if not self.data_directory.exists():
@@ -100,9 +221,23 @@ class MongoAdapter(collections.abc.Mapping):
                 {k: import_object(v) for k, v in spec_to_document_model.items()},
             )
 
+        # nodes built by __getitem__ are cached in an LRU shared by all variations
+        # of this adapter, this is opt-in because writes made outside of this
+        # adapter are not observed
+        if node_cache is None and node_cache_size > 0:
+            node_cache = NodeCache(node_cache_size)
+        self.node_cache = node_cache
+
+        # clients ask for the length of a listing with every page so counts
+        # can be cached for a few seconds, this is opt-in as writes are not
+        # counted until the entry expires
+        if length_cache is None and length_cache_ttl > 0:
+            length_cache = LengthCache(length_cache_ttl)
+        self.length_cache = length_cache
+
         super().__init__()
 
-    @property
+    @cached_property
     def sorting(self):
         return [(k, v) for k, v in self._sorting.items()]
 
@@ -115,12 +250,15 @@ class MongoAdapter(collections.abc.Mapping):
         metadata=None,
         access_policy=None,
         spec_to_document_model=None,
+        node_cache_size=0,
+        length_cache_ttl=0,
     ):
         if not pymongo.uri_parser.parse_uri(uri)["database"]:
             raise ValueError(
                 f"Invalid URI: {uri!r} " f"Did you forget to include a database?"
             )
         metadata_db = pymongo.MongoClient(uri).get_database()
+        create_indexes(metadata_db.get_collection("metadata"))
 
         return cls(
             metadata_db=metadata_db,
@@ -128,6 +266,8 @@ class MongoAdapter(collections.abc.Mapping):
             metadata=metadata,
             access_policy=access_policy,
             spec_to_document_model=spec_to_document_model,
+            node_cache_size=node_cache_size,
+            length_cache_ttl=length_cache_ttl,
         )
 
     @classmethod
@@ -138,11 +278,14 @@ class MongoAdapter(collections.abc.Mapping):
         metadata=None,
         access_policy=None,
         spec_to_document_model=None,
+        node_cache_size=0,
+        length_cache_ttl=0,
     ):
         import mongomock
 
         mongo_client = mongomock.MongoClient()
         metadata_db = mongo_client["test"]
+        create_indexes(metadata_db.get_collection("metadata"))
 
         return cls(
             metadata_db=metadata_db,
@@ -150,12 +293,17 @@ class MongoAdapter(collections.abc.Mapping):
             metadata=metadata,
             access_policy=access_policy,
             spec_to_document_model=spec_to_document_model,
+            node_cache_size=node_cache_size,
+            length_cache_ttl=length_cache_ttl,
         )
 
-    @property
+    @cached_property
     def permissions(self):
         """
         Return the permissions of the current principal
+
+        The principal is fixed for the lifetime of an instance so this is only
+        computed once.
         """
         if self.access_policy is not None:
             permissions = self.access_policy.permissions(self.principal)
@@ -204,6 +352,8 @@ class MongoAdapter(collections.abc.Mapping):
             access_policy=self.access_policy,
             principal=principal,
             spec_to_document_model=self.spec_to_document_model,
+            node_cache=self.node_cache,
+            length_cache=self.length_cache,
             **kwargs,
         )
 
@@ -247,50 +397,97 @@ class MongoAdapter(collections.abc.Mapping):
         except pydantic.ValidationError as err:
             raise HTTPException(status_code=400, detail=f"{err}")
 
-        self.metadata_collection.insert_one(validated_document.dict())
+        # the document was already validated by pydantic above
+        self.metadata_collection.insert_one(
+            validated_document.dict(), bypass_document_validation=True
+        )
         return key
 
     def _build_node_from_doc(self, doc):
         # NOTE we don't use self._get_document_model to do extra validation based on specs
         document_model = Document
 
-        if doc["structure_family"] == StructureFamily.array:
-            return WritingArrayAdapter(
-                self.metadata_collection,
-                self.data_directory,
-                document_model.parse_obj(doc),
-                self.permissions,
-            )
-        elif doc["structure_family"] == StructureFamily.dataframe:
-            return WritingDataFrameAdapter(
-                self.metadata_collection,
-                self.data_directory,
-                document_model.parse_obj(doc),
-                self.permissions,
-            )
-        else:
+        adapter = _adapter_structure_association.get(doc["structure_family"])
+        if adapter is None:
             raise ValueError("Unsupported Structure Family value in the databse")
 
+        return adapter(
+            self.metadata_collection,
+            self.data_directory,
+            document_model.from_mongo(doc),
+            self.permissions,
+        )
+
+    def _get_or_build_node(self, doc):
+        # until its data is written the document is still modified by put_data
+        if self.node_cache is None or doc.get("data_url") is None:
+            return self._build_node_from_doc(doc)
+
+        cache_key = (doc["uid"], frozenset(self.permissions))
+        node = self.node_cache.get(cache_key)
+        if node is None:
+            node = self._build_node_from_doc(doc)
+            self.node_cache.put(cache_key, node)
+        return node
+
+    @cached_property
+    def _base_query(self):
+        # the search queries are fixed for this instance so merge them once,
+        # None if their predicates overlap and they must be combined with $and
+        merged = {}
+        for query in self.queries:
+            if not merged.keys().isdisjoint(query):
+                return None
+            merged.update(query)
+        return merged
+
     def _build_mongo_query(self, *queries):
-        combined = self.queries + list(queries)
-        if combined:
-            return {"$and": combined}
-        else:
-            return {}
+        # merge into a single flat filter so equivalent queries share a shape
+        # in the plan cache, only fall back to $and if predicates overlap
+        if self._base_query is not None:
+            # copy as the result may be modified by the caller
+            merged = dict(self._base_query)
+            for query in queries:
+                if not merged.keys().isdisjoint(query):
+                    break
+                merged.update(query)
+            else:
+                return merged
+        return {"$and": self.queries + list(queries)}
 
     def __len__(self):
-        count = self.metadata_collection.count_documents(
-            # self._build_mongo_query({"active": True})
-            self._build_mongo_query({"data_url": {"$ne": None}})
-        )
-        return count
+        query = self._build_mongo_query(_has_data)
+        if self.length_cache is not None:
+            cache_key = repr(query)
+            length = self.length_cache.get(cache_key)
+            if length is not None:
+                return length
+
+        if self.queries:
+            # let the planner pick an index for the extra predicates
+            length = self.metadata_collection.count_documents(
+                query, **query_comment(self.metadata_collection, "MongoAdapter.__len__")
+            )
+        else:
+            # walk the partial index instead of scanning the collection, this
+            # is not a covered count as _has_data is still checked per document
+            length = self.metadata_collection.count_documents(
+                query,
+                hint=_listing_index,
+                **query_comment(self.metadata_collection, "MongoAdapter.__len__"),
+            )
+
+        if self.length_cache is not None:
+            self.length_cache.put(cache_key, length)
+        return length
 
     def __length_hint__(self):
         # https://www.python.org/dev/peps/pep-0424/
-        return self.metadata_collection.estimated_document_count(
-            # self._build_mongo_query({"active": True}),
-            self._build_mongo_query({"data_url": {"$ne": None}}),
-        )
+        # NOTE estimated_document_count does not accept a filter, it reads the
+        # collection metadata so this is only an upper bound
+        # NOTE operator.length_hint (used by tiled) calls __len__ when it is
+        # defined, so this is only reached by direct callers
+        return self.metadata_collection.estimated_document_count()
 
     def __repr__(self):
         # Display up to the first N keys to avoid making a giant service
@@ -299,38 +496,76 @@ class MongoAdapter(collections.abc.Mapping):
         return tree_repr(self, self._keys_slice(0, N, direction=1))
 
     def __getitem__(self, key):
+        # NOTE searches may exclude key so they do not use the cache
+        use_cache = self.node_cache is not None and not self.queries
+        if use_cache:
+            cache_key = (key, frozenset(self.permissions))
+            node = self.node_cache.get(cache_key)
+            if node is not None:
+                return node
+
         query = {"uid": key}
-        doc = self.metadata_collection.find_one(self._build_mongo_query(query))
+        doc = self.metadata_collection.find_one(
+            self._build_mongo_query(query),
+            _node_projection,
+            **query_comment(self.metadata_collection, "MongoAdapter.__getitem__"),
+        )
         if doc is None:
             raise KeyError(key)
 
-        return self._build_node_from_doc(doc)
+        return self._get_or_build_node(doc)
 
-    def _keys_slice(self, start, stop, direction):
+    def __contains__(self, key):
+        # avoid building the node as Mapping.__contains__ would
+        query = {"uid": key}
+        doc = self.metadata_collection.find_one(
+            self._build_mongo_query(query),
+            {"uid": True, "_id": False},
+            **query_comment(self.metadata_collection, "MongoAdapter.__contains__"),
+        )
+        return doc is not None
+
+    def _find_slice(self, start, stop, direction, projection, op):
         assert direction == 1, "direction=-1 should be handled by the client"
         skip = start or 0
         if stop is not None:
             limit = stop - skip
+            if limit <= 0:
+                return iter(())
         else:
-            limit = None
+            limit = 0  # NOTE mongo treats a limit of 0 as no limit
 
         order = self._sorting["_"]
-        sorting = [("last_modified", order)]  # natural given order is by last_modified
+        # natural given order is by last_modified, uid breaks ties so pages
+        # are stable
+        sorting = [("last_modified", order), ("uid", order)]
 
-        query = self._build_mongo_query({"data_url": {"$ne": None}})
+        query = self._build_mongo_query(_has_data)
 
-        for doc in (
-            self.metadata_collection.find(query, {"uid": 1})
+        return (
+            self.metadata_collection.find(
+                query, projection, **query_comment(self.metadata_collection, op)
+            )
             .sort(sorting)
             .skip(skip)
             .limit(limit)
+            .batch_size(_cursor_batch_size)
+        )
+
+    def _keys_slice(self, start, stop, direction):
+        projection = {"uid": True, "_id": False}
+        for doc in self._find_slice(
+            start, stop, direction, projection, "MongoAdapter._keys_slice"
         ):
             yield doc["uid"]
 
     def _items_slice(self, start, stop, direction):
-        for k in self._keys_slice(start, stop, direction):
-            # FIXME note this is wasteful because it requires a second db lookup to get the value
-            yield (k, self[k])
+        # fetch the documents for the whole slice with one query instead of
+        # looking up each key separately
+        for doc in self._find_slice(
+            start, stop, direction, _node_projection, "MongoAdapter._items_slice"
+        ):
+            yield (doc["uid"], self._get_or_build_node(doc))
 
     def __iter__(self):
         yield from self.keys()
@@ -7,7 +7,7 @@ from tiled.authenticators import OIDCAuthenticator
 from tiled.server.authentication import get_current_principal
 from tiled.server.utils import get_base_url
 
-from .utils import SHARE_AIMMDB_PATH
+from . import utils
 
 
 def get_code_url(request):
@@ -39,7 +39,7 @@ class AIMMAuthenticator(OIDCAuthenticator):
         )
 
         router = APIRouter()
-        templates = Jinja2Templates(Path(SHARE_AIMMDB_PATH, "templates"))
+        templates = Jinja2Templates(Path(utils.SHARE_AIMMDB_PATH, "templates"))
 
         @router.get("/login", response_class=HTMLResponse)
         async def login(
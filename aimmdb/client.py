@@ -22,6 +22,9 @@ class MongoCatalog(Node):
 
 
 class SampleKey:
+    # one of these is created for every entry in a listing
+    __slots__ = ("uid", "name")
+
     def __init__(self, uid, name):
         self.uid = uid
         self.name = name
@@ -31,6 +34,8 @@ class SampleKey:
 
 
 class XASKey:
+    __slots__ = ("uid", "element", "edge", "sample_name")
+
     def __init__(self, uid, element, edge, sample_name=None):
         self.uid = uid
         self.element = element
@@ -46,14 +51,18 @@ class XASKey:
     @classmethod
     def from_client(cls, client):
         assert isinstance(client, XASClient)
+        return cls.from_metadata(client.uid, client.metadata)
+
+    @classmethod
+    def from_metadata(cls, uid, metadata):
         try:
-            sample_name = client.metadata["sample"]["name"]
+            sample_name = metadata["sample"]["name"]
         except KeyError:
             sample_name = None
         return cls(
-            uid=client.uid,
-            element=client.element,
-            edge=client.edge,
+            uid=uid,
+            element=metadata["element"]["symbol"],
+            edge=metadata["element"]["edge"],
             sample_name=sample_name,
         )
 
@@ -74,6 +83,13 @@ class AIMMCatalog(Node):
         uid = document["uid"]
         return uid
 
+    def write_samples(self, metadata_list):
+        samples = [SampleData.parse_obj(metadata) for metadata in metadata_list]
+        document = self.context.post_json(
+            "/samples", [sample.dict() for sample in samples]
+        )
+        return document["uids"]
+
     def delete_sample(self, uid):
         self.context.delete_content(f"/sample/{uid}", None)
 
@@ -91,18 +107,50 @@ class AIMMCatalog(Node):
         else:
             return super().__delitem__(key)
 
+    def _metadata_slice(self, start, stop, fields, page_size=500):
+        # fetch keys along with only the requested metadata fields
+        # this avoids transferring and constructing a client for each entry
+        path = "".join(f"/{part}" for part in self._path)
+        offset = start or 0
+        while stop is None or offset < stop:
+            limit = page_size if stop is None else min(page_size, stop - offset)
+            params = {"fields": fields, "offset": offset, "limit": limit}
+            content = self.context.get_json(
+                f"/node/metadata_slice{path}", params=params
+            )
+            for item in content["data"]:
+                yield item["id"], item["metadata"], item["specs"]
+            if len(content["data"]) < limit:
+                return
+            offset += limit
+
     def _keys_slice(self, start, stop, direction):
         op_dict = self.metadata["_tiled"]["op"]
+        # the metadata slice does not apply client side queries or sorting
+        # fall back to annotating keys from the items in that case
+        fetch_metadata = (
+            direction > 0
+            and not self._queries
+            and ((not self.sorting) or (self.sorting == [("_", 1)]))
+        )
         if (
             op_dict["op_enum"] == "distinct"
             and op_dict["distinct"] == "metadata.sample_id"
         ):
-            for k, v in super()._items_slice(start, stop, direction):
-                yield SampleKey(uid=k, name=v.metadata["_tiled"]["sample"]["name"])
+            if not fetch_metadata:
+                yield from (k for k, _ in self._items_slice(start, stop, direction))
+                return
+            fields = ["_tiled.sample.name"]
+            for k, md, _ in self._metadata_slice(start, stop, fields):
+                yield SampleKey(uid=k, name=md["_tiled"]["sample"]["name"])
         elif op_dict["op_enum"] == "distinct" and op_dict["distinct"] == "uid":
-            for k, v in super()._items_slice(start, stop, direction):
-                if isinstance(v, XASClient):
-                    k = XASKey.from_client(v)
+            if not fetch_metadata:
+                yield from (k for k, _ in self._items_slice(start, stop, direction))
+                return
+            fields = ["element.symbol", "element.edge", "sample.name"]
+            for k, md, specs in self._metadata_slice(start, stop, fields):
+                if "XAS" in specs:
+                    k = XASKey.from_metadata(k, md)
                 yield k
         else:
             yield from super()._keys_slice(start, stop, direction)
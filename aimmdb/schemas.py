@@ -1,5 +1,6 @@
 from datetime import datetime
 from enum import Enum
+from functools import lru_cache
 from typing import Dict, Generic, List, Optional, TypeVar, Union
 
 import pydantic
@@ -29,6 +30,24 @@ class GenericDocument(pydantic.generics.GenericModel, Generic[MetadataT]):
     data_url: Optional[pydantic.AnyUrl]
     last_modified: Optional[datetime]
 
+    @classmethod
+    def from_mongo(cls, doc):
+        """
+        Build a document which was validated when it was written to the database
+
+        The metadata is not validated again, only the (small) structure and
+        data_url are parsed because the adapters need them as models.
+        """
+        values = {k: v for k, v in doc.items() if k in cls.__fields__}
+        values["structure_family"] = StructureFamily(doc["structure_family"])
+        structure_type = structure_association[values["structure_family"]]
+        values["structure"] = structure_type.parse_obj(doc["structure"])
+        metadata_type = cls.__fields__["metadata"].type_
+        values["metadata"] = metadata_type.construct(**doc["metadata"])
+        if doc.get("data_url") is not None:
+            values["data_url"] = pydantic.parse_obj_as(pydantic.AnyUrl, doc["data_url"])
+        return cls.construct(**values)
+
     @pydantic.root_validator(skip_on_failure=True)
     def validate_structure_matches_structure_family(cls, values):
         # actual_structure_type = cls.__annotations__["structure"]  # this is what was filled in for StructureT
@@ -80,21 +99,30 @@ class GenericDocument(pydantic.generics.GenericModel, Generic[MetadataT]):
         return v
 
 
+# element data is loaded on first validation, keep frozensets for O(1) lookup
+@lru_cache(maxsize=1)
+def _element_symbols():
+    return frozenset(get_element_data()["symbols"])
+
+
+@lru_cache(maxsize=1)
+def _element_edges():
+    return frozenset(get_element_data()["edges"])
+
+
 class XDIElement(pydantic.BaseModel):
     symbol: str
     edge: str
 
     @pydantic.validator("symbol")
     def check_symbol(cls, s):
-        symbols = get_element_data()["symbols"]
-        if s not in symbols:
+        if s not in _element_symbols():
             raise ValueError(f"{s} not a valid element symbol")
         return s
 
     @pydantic.validator("edge")
     def check_edge(cls, e):
-        edges = get_element_data()["edges"]
-        if e not in edges:
+        if e not in _element_edges():
             raise ValueError(f"{e} not a valid edge")
         return e
 
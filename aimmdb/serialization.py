@@ -6,10 +6,10 @@ import pyarrow.parquet as pq
 
 
 def serialize_npy(x):
-    with io.BytesIO() as f:
-        np.save(f, x)
-        buf = f.getvalue()
-        return memoryview(buf)
+    f = io.BytesIO()
+    np.save(f, x)
+    # NOTE getbuffer avoids the copy made by getvalue, the view keeps f alive
+    return f.getbuffer()
 
 
 def serialize_parquet(df):
@@ -22,5 +22,15 @@ def serialize_parquet(df):
 
 def deserialize_parquet(data):
     reader = pa.BufferReader(data)
-    table = pq.read_table(reader)
-    return table.to_pandas()
+    table = pq.read_table(reader, pre_buffer=True)
+    # NOTE self_destruct releases each column once converted to keep peak
+    # memory near one copy, table must not be used afterwards
+    return table.to_pandas(self_destruct=True)
+
+
+def read_parquet(path, columns=None):
+    # memory map the file instead of reading it into a buffer first
+    table = pq.read_table(
+        path, columns=columns, memory_map=True, use_pandas_metadata=True
+    )
+    return table.to_pandas(self_destruct=True)
@@ -1,4 +1,4 @@
-from typing import Dict
+from typing import Dict, List
 
 import pydantic
 from fastapi import APIRouter, Depends, HTTPException, Request, Security
@@ -12,6 +12,10 @@ class PostSampleResponse(pydantic.BaseModel):
     uid: str
 
 
+class PostSamplesResponse(pydantic.BaseModel):
+    uids: List[str]
+
+
 router = APIRouter()
 
 
@@ -33,6 +37,24 @@ def post_sample(
     return json_or_msgpack(request, {"uid": uid})
 
 
+@router.post("/samples", response_model=PostSamplesResponse)
+def post_samples(
+    request: Request,
+    samples: List[SampleData],
+    root=Security(get_root_tree, scopes=["write:data", "write:metadata"]),
+    principal: str = Depends(get_current_principal),
+):
+    entry = root.authenticated_as(principal)
+    try:
+        uids = entry.post_samples(samples)
+    except AttributeError:
+        raise HTTPException(
+            status_code=404, detail="tree does not support posting sample metadata"
+        )
+
+    return json_or_msgpack(request, {"uids": uids})
+
+
 @router.delete("/sample/{uid}")
 def delete_sample(
     request: Request,
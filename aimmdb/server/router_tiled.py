@@ -1,6 +1,8 @@
 # place for routes to be upstreamed into tiled
+from typing import List
+
 import pydantic
-from fastapi import APIRouter, HTTPException, Request, Security
+from fastapi import APIRouter, HTTPException, Query, Request, Security
 from tiled.server.core import json_or_msgpack
 from tiled.server.dependencies import entry
 
@@ -9,3 +11,45 @@ router = APIRouter()
 # TODO /dataframe/partition
 # TODO /array/block
 # TODO xarray
+
+
+def _normalize_fields(fields):
+    # a projection may not name both a path and one of its children (mongo
+    # rejects it as a path collision) so keep only the outermost paths
+    out = []
+    for field in sorted(set(fields), key=lambda field: field.count(".")):
+        parts = field.split(".")
+        if not all(parts) or any(part.startswith("$") for part in parts):
+            raise HTTPException(status_code=400, detail=f"invalid field {field!r}")
+        if any(field.startswith(f"{parent}.") for parent in out):
+            continue
+        out.append(field)
+    return out
+
+
+@router.get("/node/metadata_slice/{path:path}")
+def metadata_slice(
+    request: Request,
+    fields: List[str] = Query([]),
+    offset: int = Query(0, ge=0),
+    limit: int = Query(100, gt=0, le=1000),
+    entry=Security(entry, scopes=["read:metadata"]),
+):
+    """
+    Return the keys of a node along with only the requested metadata fields
+
+    fields are dotted paths into the metadata e.g. element.symbol
+    """
+    try:
+        metadata_slice = entry.metadata_slice
+    except AttributeError:
+        raise HTTPException(
+            status_code=404, detail="node does not support metadata slices"
+        )
+
+    fields = _normalize_fields(fields)
+    data = [
+        {"id": key, "metadata": metadata, "specs": specs}
+        for key, metadata, specs in metadata_slice(offset, offset + limit, fields)
+    ]
+    return json_or_msgpack(request, {"data": data})
@@ -1,6 +1,7 @@
 import math
 import os
 import sys
+import threading
 
 # adapted from shortuuid
 # see https://github.com/skorokithakis/shortuuid
@@ -15,26 +16,58 @@ _alphabet_len = len(_alphabet)
 _uid_bytes = 8
 _uid_length = int(math.ceil(math.log(256**_uid_bytes, _alphabet_len)))
 
+_alphabet_index = {char: i for i, char in enumerate(_alphabet)}
+# every pair of digits so each divmod yields two digits
+_pair_base = _alphabet_len**2
+_alphabet_pairs = [a + b for a in _alphabet for b in _alphabet]
+
 
 def int_to_string(number, padding=_uid_length):
-    output = ""
+    pairs = []
     while number:
-        number, digit = divmod(number, _alphabet_len)
-        output += _alphabet[digit]
+        number, pair = divmod(number, _pair_base)
+        pairs.append(_alphabet_pairs[pair])
 
+    # the leading pair may start with a zero digit
+    output = "".join(reversed(pairs)).lstrip(_alphabet[0])
     if padding:
-        remainder = max(padding - len(output), 0)
-        output = output + _alphabet[0] * remainder
-    return output[::-1]
+        output = output.rjust(padding, _alphabet[0])
+    return output
 
 
 def string_to_int(string):
     number = 0
-    for char in string:
-        number = number * _alphabet_len + _alphabet.index(char)
+    try:
+        for char in string:
+            number = number * _alphabet_len + _alphabet_index[char]
+    except KeyError as e:
+        raise ValueError(f"{e.args[0]!r} is not in the alphabet") from None
     return number
 
 
+# os.urandom is a syscall so draw the entropy for many uids at once
+_pool_uids = 4096
+_pool = bytearray()
+_pool_lock = threading.Lock()
+
+
+def _reset_pool():
+    global _pool, _pool_lock
+    _pool = bytearray()
+    _pool_lock = threading.Lock()
+
+
+# a forked child must not hand out the same uids as its parent
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=_reset_pool)
+
+
 def uid():
-    x = int.from_bytes(os.urandom(_uid_bytes), sys.byteorder)
+    global _pool
+    with _pool_lock:
+        if len(_pool) < _uid_bytes:
+            _pool = bytearray(os.urandom(_uid_bytes * _pool_uids))
+        chunk = bytes(_pool[-_uid_bytes:])
+        del _pool[-_uid_bytes:]
+    x = int.from_bytes(chunk, sys.byteorder)
     return int_to_string(x)
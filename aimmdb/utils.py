@@ -1,9 +1,12 @@
 import dataclasses
 import importlib
+import importlib.resources
 import json
+from functools import lru_cache
 
 import h5py
 import pydantic
+import pymongo
 
 
 def make_dict(x):
@@ -15,14 +18,18 @@ def make_dict(x):
         return x
 
 
-# read an hdf5 group recursively into memory
+# read an hdf5 group (and its subgroups) into memory
 def read_group(g, jsoncompat=False):
     out = {}
-    for k, v in g.items():
-        if isinstance(v, h5py.Group):  # group
-            x = read_group(v, jsoncompat=jsoncompat)
-        else:  # dataset
-            if v.shape == ():  # scalar
+    # walk the groups with an explicit stack instead of recursing
+    stack = [(g, out)]
+    while stack:
+        group, dst = stack.pop()
+        for k, v in group.items():
+            if isinstance(v, h5py.Group):  # group
+                x = {}
+                stack.append((v, x))
+            elif v.shape == ():  # scalar
                 x = v[()]
                 if type(x) is bytes:
                     x = x.decode("utf-8")
@@ -33,24 +40,55 @@ def read_group(g, jsoncompat=False):
                 x = v[:]
                 if jsoncompat:
                     x = x.tolist()
-        out[k] = x
+            dst[k] = x
     return out
 
 
-_ELEMENT_DATA = None
+class LazyRouters:
+    """
+    Class attribute which imports routers on first access
 
+    The result is cached on the owning class so the import only happens once.
 
+    >>> include_routers = LazyRouters("aimmdb.server.router_tiled:router")
+    """
+
+    def __init__(self, *import_paths):
+        self.import_paths = import_paths
+
+    def __set_name__(self, owner, name):
+        self.owner = owner
+        self.name = name
+
+    def __get__(self, obj, objtype=None):
+        routers = []
+        for import_path in self.import_paths:
+            module_name, _, attr = import_path.partition(":")
+            routers.append(getattr(importlib.import_module(module_name), attr))
+        setattr(self.owner, self.name, routers)
+        return routers
+
+
+def query_comment(collection, op):
+    """
+    Return find/count kwargs tagging a query as aimmdb.<op> for the profiler
+
+    mongomock rejects the comment option so nothing is added for it.
+    """
+    if isinstance(collection, pymongo.collection.Collection):
+        return {"comment": f"aimmdb.{op}"}
+    return {}
+
+
+# load on first access
+@lru_cache(maxsize=1)
 def get_element_data():
-    # load on first access
-    global _ELEMENT_DATA
-    if _ELEMENT_DATA is None:
-        fname = importlib.resources.files("aimmdb") / "data" / "elements.json"
-        with open(fname, "r") as f:
-            data = json.load(f)
-        _ELEMENT_DATA = data
-    return _ELEMENT_DATA
+    fname = importlib.resources.files("aimmdb") / "data" / "elements.json"
+    return json.loads(fname.read_bytes())
 
 
+# resolved on first use rather than on import, this walks the filesystem
+@lru_cache(maxsize=1)
 def get_share_aimmdb_path():
     """Walk up until we find share/aimmdb"""
     import sys
@@ -75,5 +113,8 @@ def get_share_aimmdb_path():
     return ""
 
 
-# Package managers can just override this with the appropriate constant
-SHARE_AIMMDB_PATH = get_share_aimmdb_path()
+def __getattr__(name):
+    # Package managers can just override this with the appropriate constant
+    if name == "SHARE_AIMMDB_PATH":
+        return get_share_aimmdb_path()
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")